@@ -16,18 +16,77 @@
 # limitations under the License.
 
 import os
+import re
 import sys
+import mmap
 import time
 import serial
+import serial.tools.list_ports
 import logging
 import binascii
 import argparse
+import threading
+import concurrent.futures
+from enum import IntEnum
 from xmodem import XMODEM
 from struct import pack
 
+class FirmwareProtocol(IntEnum):
+    ZIGBEE = 0
+    THREAD = 1
+
+    def __str__(self):
+        return self.name.lower()
+
+# Firmware images are shipped next to this script, whatever the working directory
+FW_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+# Latest firmware image for each Elelabs product and protocol version
+FW_TABLE = {
+    ("ELR023", FirmwareProtocol.THREAD): os.path.join(FW_DIR, "EFR32MG13", "ELE_MG13_ot_rcp_123_220206.gbl"),
+    ("ELR023", FirmwareProtocol.ZIGBEE): os.path.join(FW_DIR, "EFR32MG13", "ELE_MG13_zb_ncp_115200_610_211112.gbl"),
+    ("ELU0143", FirmwareProtocol.THREAD): os.path.join(FW_DIR, "EFR32MG21", "ELU0143_MG21_ot_rcp_123_220131.gbl"),
+    ("ELU0143", FirmwareProtocol.ZIGBEE): os.path.join(FW_DIR, "EFR32MG21", "ELU0143_MG21_zb_ncp_6103_220131.gbl"),
+    ("ELU0141", FirmwareProtocol.THREAD): os.path.join(FW_DIR, "EFR32MG21", "ELU0141_MG21_ot_rcp_123_211204.gbl"),
+    ("ELU0141", FirmwareProtocol.ZIGBEE): os.path.join(FW_DIR, "EFR32MG21", "ELU0141_MG21_zb_ncp_6103_211204.gbl"),
+}
+FW_PRODUCTS = {adapter_name for adapter_name, version in FW_TABLE}
+# Products running the same firmware as another one, probe() reports the latter
+ADAPTER_ALIASES = {"ELU013": "ELR023", "ELU0142": "ELU0141"}
+# Elelabs products without an update path yet
+FW_UNSUPPORTED = ("ELR022", "ELU012", "EZBPIS", "EZBUSBA")
+
+# Logger level for each --dlevel choice, RAW and PACKET dumps are logged at DEBUG
+LOG_LEVELS = {'INFO': logging.INFO, 'DEBUG': logging.DEBUG}
+
+# Firmware images mapped so far, shared by every upload in this process
+FW_IMAGES = {}
+FW_IMAGES_LOCK = threading.Lock()
+
+def load_firmware(path):
+    """ Map a firmware image read-only, once per process for repeated uploads. """
+    with FW_IMAGES_LOCK:
+        if path not in FW_IMAGES:
+            with open(path, 'rb') as f:
+                FW_IMAGES[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return FW_IMAGES[path]
+
+def close_firmware():
+    """ Unmap every firmware image loaded by load_firmware. """
+    with FW_IMAGES_LOCK:
+        for image in FW_IMAGES.values():
+            image.close()
+        FW_IMAGES.clear()
+
+def firmware_protocol(arg):
+    try:
+        return FirmwareProtocol[arg.upper()]
+    except KeyError:
+        raise argparse.ArgumentTypeError(f"invalid choice: '{arg}'")
+
 def is_valid_file(parser, arg):
     if not os.path.isfile(arg):
-        parser.error("The file %s does not exist!" % arg)
+        parser.error(f"The file {arg} does not exist!")
     else:
         return arg
 
@@ -55,8 +114,10 @@ parser_flash.add_argument('-d','--dlevel', choices=['RAW', 'PACKET', 'DEBUG', 'I
 parser_flash.set_defaults(which='flash')
 
 parser_ele_update = subparsers.add_parser('ele_update', help='Updates the Elelabs product to a latest available version')
-parser_ele_update.add_argument('-v','--version', choices=['zigbee', 'thread'], required=True, help='Required protocol version')
-parser_ele_update.add_argument('-p','--port', type=str, required=True, help='Serial port for the Elelabs Product')
+parser_ele_update.add_argument('-v','--version', type=firmware_protocol, choices=list(FirmwareProtocol), required=True, help='Required protocol version')
+parser_ele_update_port = parser_ele_update.add_mutually_exclusive_group(required=True)
+parser_ele_update_port.add_argument('-p','--port', type=str, help='Serial port for the Elelabs Product')
+parser_ele_update_port.add_argument('-a','--all', action='store_true', help='Update the Elelabs products on all USB serial ports in parallel')
 parser_ele_update.add_argument('-b','--baudrate', type=str, required=False, default=115200, help='Serial baud rate for NCP (115200/57600)')
 parser_ele_update.add_argument('-d','--dlevel', choices=['RAW', 'PACKET', 'DEBUG', 'INFO'], required=False, default='INFO', help='Debug verbosity level')
 parser_ele_update.set_defaults(which='ele_update')
@@ -67,10 +128,17 @@ class AdapterModeProbeStatus:
     BOOTLOADER = 2
     ERROR = 3
 
+# Reason ele_update gives up for each probe result other than ZIGBEE/THREAD
+PROBE_STATUS_ERRORS = {
+    AdapterModeProbeStatus.BOOTLOADER: "The product not in the normal EZSP mode.\r\n'restart' into normal mode or use 'flash' utility instead",
+    AdapterModeProbeStatus.ERROR: "No upgradable device found",
+}
+
 class SerialInterface:
-    def __init__(self, port, baudrate):
+    def __init__(self, port, baudrate, exclusive=False):
         self.port = port
         self.baudrate = baudrate
+        self.exclusive = exclusive
 
     def open(self):
         try:
@@ -79,103 +147,137 @@ class SerialInterface:
                 parity=serial.PARITY_NONE,
                 stopbits=serial.STOPBITS_ONE,
                 xonxoff=True,
-                timeout=3)
+                timeout=3,
+                # None keeps pyserial's default, win32 rejects an explicit False
+                exclusive=True if self.exclusive else None)
         except Exception as e:
-            raise Exception("PORT ERROR: %s" % str(e))
+            raise Exception(f"PORT ERROR: {e}")
 
     def close(self):
         self.serial.close()
 
+class FastXMODEM(XMODEM):
+    def calc_crc(self, data, crc=0):
+        # Same CRC-16/XMODEM as the stock implementation, computed in C
+        return binascii.crc_hqx(data, crc)
+
+class FirmwareReader:
+    """ Own read position over a mapped firmware image, one per upload. """
+    def __init__(self, image):
+        self.view = memoryview(image)
+        self.offset = 0
+
+    def read(self, size):
+        data = self.view[self.offset:self.offset + size]
+        self.offset += len(data)
+        # XMODEM pads the last block with ljust(), so hand out bytes
+        return bytes(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # Release the view so close_firmware() can unmap the image
+        self.view.release()
+
 class AshProtocolInterface:
     FLAG_BYTE = b'\x7E'
     RANDOMIZE_START =  0x42
     RANDOMIZE_SEQ = 0xB8
+    RANDOMIZE_KEYSTREAM_LEN = 4096
     RSTACK_FRAME_CMD = b'\x1A\xC0\x38\xBC\x7E'
     RSTACK_FRAME_ACK = b'\x1A\xC1\x02\x0B\x0A\x52\x7E'
 
+    # Reserved bytes are sent as 0x7D followed by the byte with bit 5 flipped
+    RESERVED_BYTES_RE = re.compile(rb'[\x7d\x7e\x11\x13\x18\x1a]')
+    ESCAPED_BYTES_RE = re.compile(rb'\x7d[\x5d\x5e\x31\x33\x38\x3a]')
+    ESCAPE_MAP = {bytes([byte]): bytes([0x7d, byte ^ 0x20]) for byte in b'\x7d\x7e\x11\x13\x18\x1a'}
+    UNESCAPE_MAP = {escaped: byte for byte, escaped in ESCAPE_MAP.items()}
+
+    # DATA frame control bytes, indexed by (frmNum << 3) | ackNum
+    DATA_CONTROL_BYTES = tuple(bytes([(frmNum << 4) | ackNum]) for frmNum in range(8) for ackNum in range(8))
+
+    # Pseudo-random sequence shared by every frame, generated on first use
+    randomizeKeystream = b''
+
     def __init__(self, serial, config, logger):
         self.logger = logger
         self.config = config
+        self.logRaw = config.dlevel == 'RAW'
+        self.logPacket = self.logRaw or config.dlevel == 'PACKET'
         self.serial = serial
 
         self.ackNum = 0
         self.frmNum = 0
-
-    def dataRandomize(self, frame):
-        rand = self.RANDOMIZE_START
-        out = bytearray()
-        for x in frame:
-            out += bytearray([x ^ rand])
+        # ACK waiting to be written in front of the next request
+        self.pendingAck = b''
+
+        # ACK frames only depend on the 3-bit ackNum, build all of them once
+        self.ackFrames = [self.ackFrameBuilder(ackNum) for ackNum in range(8)]
+
+    @classmethod
+    def mkRandomizeKeystream(cls, length):
+        """ Generate the ASH data randomization sequence of the given length. """
+        rand = cls.RANDOMIZE_START
+        out = bytearray(length)
+        for i in range(length):
+            out[i] = rand
             if rand % 2:
-                rand = (rand >> 1) ^ self.RANDOMIZE_SEQ
+                rand = (rand >> 1) ^ cls.RANDOMIZE_SEQ
             else:
                 rand = rand >> 1
-        return out
+        return bytes(out)
+
+    def dataRandomize(self, frame):
+        length = len(frame)
+        if length > len(self.randomizeKeystream):
+            AshProtocolInterface.randomizeKeystream = self.mkRandomizeKeystream(max(length, self.RANDOMIZE_KEYSTREAM_LEN))
+        key = int.from_bytes(self.randomizeKeystream[:length], "big")
+        return bytearray((int.from_bytes(frame, "big") ^ key).to_bytes(length, "big"))
 
     def ashFrameBuilder(self, ezsp_frame):
-        ash_frame = bytearray()
         # Control byte
-        ash_frame += bytearray([(((self.ackNum << 0) & 0xFF) | (((self.frmNum % 8) << 4 ) & 0xFF)) & 0xFF])
+        ash_frame = self.DATA_CONTROL_BYTES[(self.frmNum << 3) | self.ackNum] + self.dataRandomize(ezsp_frame)
         self.ackNum = (self.ackNum + 1) % 8
         self.frmNum = (self.frmNum + 1) % 8
-        ash_frame += self.dataRandomize(ezsp_frame)
         crc = binascii.crc_hqx(ash_frame, 0xFFFF)
-        ash_frame += bytearray([crc >> 8, crc & 0xFF])
-        ash_frame = self.replaceReservedBytes(ash_frame)
-        ash_frame += self.FLAG_BYTE
-        if self.config.dlevel == 'RAW':
-            self.logger.debug('[ ASH  REQUEST ] ' + ' '.join(format(x, '02x') for x in ash_frame))
+        ash_frame = self.replaceReservedBytes(ash_frame + pack(">H", crc)) + self.FLAG_BYTE
+        if self.logRaw:
+            self.logger.debug('[ ASH  REQUEST ] ' + ash_frame.hex(' '))
         return ash_frame
 
     def revertEscapedBytes(self, msg):
-        msg = msg.replace(b'\x7d\x5d', b'\x7d')
-        msg = msg.replace(b'\x7d\x5e', b'\x7e')
-        msg = msg.replace(b'\x7d\x31', b'\x11')
-        msg = msg.replace(b'\x7d\x33', b'\x13')
-        msg = msg.replace(b'\x7d\x38', b'\x18')
-        msg = msg.replace(b'\x7d\x3a', b'\x1a')
-        return msg
+        return self.ESCAPED_BYTES_RE.sub(lambda m: self.UNESCAPE_MAP[m.group()], msg)
 
     def replaceReservedBytes(self, msg):
-        msg = msg.replace(b'\x7d', b'\x7d\x5d')
-        msg = msg.replace(b'\x7e', b'\x7d\x5e')
-        msg = msg.replace(b'\x11', b'\x7d\x31')
-        msg = msg.replace(b'\x13', b'\x7d\x33')
-        msg = msg.replace(b'\x18', b'\x7d\x38')
-        msg = msg.replace(b'\x1a', b'\x7d\x3a')
-        return msg
+        return self.RESERVED_BYTES_RE.sub(lambda m: self.ESCAPE_MAP[m.group()], msg)
 
     def getResponse(self, applyRandomize = False):
-        timeout = time.time() + 3
-        msg = bytearray()
+        # Port timeout (3s) bounds the wait for the closing flag
+        msg = self.serial.read_until(self.FLAG_BYTE)
 
-        receivedbyte = None
-
-        while (time.time() < timeout) and (receivedbyte != self.FLAG_BYTE):
-            receivedbyte = self.serial.read()
-            msg += receivedbyte
-
-        if len(msg) == 0:
+        if not msg.endswith(self.FLAG_BYTE):
             return -1, None, None
 
         msg = self.revertEscapedBytes(msg)
 
-        if self.config.dlevel == 'RAW':
-            self.logger.debug('[ ASH RESPONSE ] ' + ' '.join(format(x, '02x') for x in msg))
+        if self.logRaw:
+            self.logger.debug('[ ASH RESPONSE ] ' + msg.hex(' '))
 
         if applyRandomize:
-            msg_parsed = self.dataRandomize(bytearray(msg[1:-3]))
-            if self.config.dlevel == 'RAW' or self.config.dlevel == 'PACKET':
-                self.logger.debug('[ EZSP RESPONSE ] ' + ' '.join(format(x, '02x') for x in msg_parsed))
+            msg_parsed = self.dataRandomize(msg[1:-3])
+            if self.logPacket:
+                self.logger.debug('[ EZSP RESPONSE ] ' + msg_parsed.hex(' '))
             return 0, msg, msg_parsed
         else:
             return 0, msg, None
 
     def sendResetFrame(self):
-        self.serial.flushInput()
+        self.serial.reset_input_buffer()
+        self.pendingAck = b''
         self.logger.debug('RESET FRAME')
-        if self.config.dlevel == 'RAW':
-            self.logger.debug('[ ASH  REQUEST ] ' + ' '.join(format(x, '02x') for x in self.RSTACK_FRAME_CMD))
+        if self.logRaw:
+            self.logger.debug('[ ASH  REQUEST ] ' + self.RSTACK_FRAME_CMD.hex(' '))
         self.serial.write(self.RSTACK_FRAME_CMD)
         status, ash_response, ezsp_response = self.getResponse()
 
@@ -187,32 +289,51 @@ class AshProtocolInterface:
 
         return 0
 
-    def sendAck(self, ackNum):
+    def ackFrameBuilder(self, ackNum):
         ack = bytearray([ackNum & 0x07 | 0x80])
         crc = binascii.crc_hqx(ack, 0xFFFF)
         ack += bytearray([crc >> 8, crc & 0xFF])
         ack = self.replaceReservedBytes(ack)
         ack += self.FLAG_BYTE
+        return bytes(ack)
+
+    def sendAck(self, ackNum):
+        ack = self.ackFrames[ackNum & 0x07]
 
-        if self.config.dlevel == 'RAW':
-            self.logger.debug('[ ASH ACK ] ' + ' '.join(format(x, '02x') for x in ack))
+        if self.logRaw:
+            self.logger.debug('[ ASH ACK ] ' + ack.hex(' '))
         self.serial.write(ack)
 
+    def queueAck(self, ackNum):
+        """ Hold the ACK back so it goes out in the same write as the next request. """
+        self.pendingAck = self.ackFrames[ackNum & 0x07]
+
+        if self.logRaw:
+            self.logger.debug('[ ASH ACK ] ' + self.pendingAck.hex(' '))
+
+    def flushAck(self):
+        """ Write the held back ACK, the session ends without another request. """
+        if self.pendingAck:
+            self.serial.write(self.pendingAck)
+            self.pendingAck = b''
+
     def sendAshCommand(self, ezspFrame):
         ash_frame = self.ashFrameBuilder(ezspFrame)
-        self.serial.flushInput()
-        self.serial.write(ash_frame)
+        self.serial.reset_input_buffer()
+        self.serial.write(self.pendingAck + ash_frame)
+        self.pendingAck = b''
         status, ash_response, ezsp_response = self.getResponse(True)
         if status:
             return status, None
 
-        self.sendAck(ash_response[0])
+        self.queueAck(ash_response[0])
         return 0, ezsp_response
 
 class EzspProtocolInterface:
-    def __init__(self, serial, config, logger):
+    def __init__(self, serial, config, logger, knownEzspVersion=None):
         self.logger = logger
         self.config = config
+        self.logPacket = config.dlevel in ('RAW', 'PACKET')
 
         self.INITIAL_EZSP_VERSION = 4
 
@@ -226,39 +347,48 @@ class EzspProtocolInterface:
         self.EZSP_MFG_BOARD_NAME = 0x02
         self.STANDALONE_BOOTLOADER_NORMAL_MODE = 1
 
-        self.ezspVersion = self.INITIAL_EZSP_VERSION
+        # Version negotiated earlier with the same adapter, if any
+        self.knownEzspVersion = knownEzspVersion
+        self.setEzspVersion(self.INITIAL_EZSP_VERSION)
         self.sequenceNum = 0
         self.ash = AshProtocolInterface(serial, config, logger)
 
-    def ezspFrameBuilder(self, command):
-        ezsp_frame = bytearray()
+    def ezspFrameBodyV4(self, command):
+        # Frame control
+        return b'\x00' + command
+
+    def ezspFrameBodyV5(self, command):
+        # Frame control, legacy frame ID (always 0xFF), extended frame control
+        return b'\x00\xFF\x00' + command
+
+    def ezspFrameBodyV8(self, command):
+        # 16-bit frame control, 16-bit frame ID (LSB, MSB)
+        return b'\x00\x01' + command[:1] + b'\x00' + command[1:]
+
+    def setEzspVersion(self, version):
+        """ Switch to the frame format of the given EZSP version. """
+        self.ezspVersion = version
+        if version >= 8:
+            self.ezspFrameBody = self.ezspFrameBodyV8
+        elif version >= 5:
+            self.ezspFrameBody = self.ezspFrameBodyV5
+        else:
+            self.ezspFrameBody = self.ezspFrameBodyV4
 
+    def ezspFrameBuilder(self, command):
         # Sequence byte
-        ezsp_frame += bytearray([self.sequenceNum])
+        ezsp_frame = bytearray([self.sequenceNum]) + self.ezspFrameBody(command)
         self.sequenceNum = (self.sequenceNum + 1) % 255
-        ezsp_frame += b'\x00'
-        if self.ezspVersion >=5:
-            # Legacy frame ID - always 0xFF
-            ezsp_frame += b'\xFF'
-            # Extended frame control
-            ezsp_frame += b'\x00'
-
-        ezsp_frame = ezsp_frame + command
-
-        if self.ezspVersion >= 8:
-            ezsp_frame[2] = 0x01
-            ezsp_frame[3] = command[0] & 0xFF # LSB
-            ezsp_frame[4] = command[0] >> 8  # MSB
-
-        if self.config.dlevel == 'RAW' or self.config.dlevel == 'PACKET':
-            self.logger.debug('[ EZSP  REQUEST ] ' + ' '.join(format(x, '02x') for x in ezsp_frame))
+
+        if self.logPacket:
+            self.logger.debug('[ EZSP  REQUEST ] ' + ezsp_frame.hex(' '))
         return ezsp_frame
 
     def sendEzspCommand(self, commandData, commandName = ''):
         self.logger.debug(commandName)
         status, response = self.ash.sendAshCommand(self.ezspFrameBuilder(commandData))
         if status:
-            raise Exception("sendAshCommand status error: %d" % status)
+            raise Exception(f"sendAshCommand status error: {status}")
 
         return response
 
@@ -289,110 +419,114 @@ class EzspProtocolInterface:
         if ash_status:
             return ash_status
 
-        self.ezspVersion = self.sendVersion(self.INITIAL_EZSP_VERSION)
-        self.logger.debug("EZSP v%d detected" % self.ezspVersion)
-        if (self.ezspVersion != self.INITIAL_EZSP_VERSION):
+        # Asking for the already known version first saves the second round trip
+        desiredVersion = self.knownEzspVersion or self.INITIAL_EZSP_VERSION
+        self.setEzspVersion(self.sendVersion(desiredVersion))
+        self.logger.debug("EZSP v%d detected", self.ezspVersion)
+        if (self.ezspVersion != desiredVersion):
             self.sendVersion(self.ezspVersion)
 
         return 0
 
 class HdlcLiteProtocolInterface:
-    HDLC_FLAG = 0x7e
-    HDLC_ESCAPE = 0x7d
+    HDLC_FLAG_BYTE = b'\x7e'
+    HDLC_ESCAPED_RE = re.compile(rb'\x7d(.)', re.DOTALL)
 
     HDLC_FCS_INIT = 0xFFFF
     HDLC_FCS_POLY = 0x8408
     HDLC_FCS_GOOD = 0xF0B8
 
+    # FCS16 lookup tables shared by every interface, generated on first use
+    fcstab = None
+    fcstabs = None
+
     def __init__(self, serial, config, logger):
         self.logger = logger
         self.config = config
+        self.logRaw = config.dlevel == 'RAW'
         self.serial = serial
-        self.fcstab = self.mkfcstab()
+        if self.fcstabs is None:
+            HdlcLiteProtocolInterface.fcstab = self.mkfcstab()
+            HdlcLiteProtocolInterface.fcstabs = self.mkfcstabs(self.fcstab)
 
     def mkfcstab(self):
-        """ Make a static lookup table for byte value to FCS16 result. """
-        polynomial = self.HDLC_FCS_POLY
+        """ Make a static lookup table for byte value to FCS16 result.
 
-        def valiter():
-            """ Helper to yield FCS16 table entries for each byte value. """
-            for byte in range(256):
+        The FCS is linear, so only single-bit bytes need the bitwise division;
+        every other entry is the XOR of two entries computed before it.
+        """
+        polynomial = self.HDLC_FCS_POLY
+        fcstab = [0] * 256
+        for byte in range(1, 256):
+            lowbit = byte & -byte
+            if byte == lowbit:
                 fcs = byte
-                i = 8
-                while i:
+                for i in range(8):
                     fcs = (fcs >> 1) ^ polynomial if fcs & 1 else fcs >> 1
-                    i -= 1
-
-                yield fcs & 0xFFFF
-
-        return tuple(valiter())
-
-    def fcs16(self, byte, fcs):
-        fcs = (fcs >> 8) ^ self.fcstab[(fcs ^ byte) & 0xff]
+                fcstab[byte] = fcs
+            else:
+                fcstab[byte] = fcstab[lowbit] ^ fcstab[byte ^ lowbit]
+        return tuple(fcstab)
+
+    def mkfcstabs(self, fcstab):
+        """ Make the four slicing-by-4 tables, the first one being fcstab itself.
+
+        Entry n of table k is the FCS16 contribution of byte n followed by k zero bytes.
+        """
+        fcstabs = [fcstab]
+        for _ in range(3):
+            fcstabs.append(tuple((fcs >> 8) ^ fcstab[fcs & 0xff] for fcs in fcstabs[-1]))
+        return tuple(fcstabs)
+
+    def fcs16buf(self, data, fcs=HDLC_FCS_INIT):
+        """ Run FCS16 over every byte of the given buffer, four bytes per step. """
+        t0, t1, t2, t3 = self.fcstabs
+        aligned = len(data) & ~3
+        quads = iter(data[:aligned])
+        for b0, b1, b2, b3 in zip(quads, quads, quads, quads):
+            fcs ^= b0 | (b1 << 8)
+            fcs = t3[fcs & 0xff] ^ t2[fcs >> 8] ^ t1[b2] ^ t0[b3]
+        for byte in data[aligned:]:
+            fcs = (fcs >> 8) ^ t0[(fcs ^ byte) & 0xff]
         return fcs
 
+    def unescape(self, data):
+        """ Revert HDLC escaping of the given frame body. """
+        return self.HDLC_ESCAPED_RE.sub(lambda m: bytes([m.group(1)[0] ^ 0x20]), data)
+
     def getResponse(self):
-        fcs = self.HDLC_FCS_INIT
         timeout = time.time() + 3
-        packet = bytearray()
+        frame = self.HDLC_FLAG_BYTE
 
-        while (time.time() < timeout):
-            byte = int.from_bytes(self.serial.read(1), "little")
-            if byte == self.HDLC_FLAG:
-                if len(packet) == 0:
-                    # First sync byte
-                    continue
-                else:
-                    # end of packet, go parse
-                    break
-            if byte == self.HDLC_ESCAPE:
-                byte = int.from_bytes(self.serial.read(1), "little")
-                byte ^= 0x20
-            packet.append(byte)
-            fcs = self.fcs16(byte, fcs)
-
-        if len(packet) == 0:
+        while (frame == self.HDLC_FLAG_BYTE) and (time.time() < timeout):
+            # Leading sync flags are read on their own, skip them
+            frame = self.serial.read_until(self.HDLC_FLAG_BYTE)
+
+        if not frame.endswith(self.HDLC_FLAG_BYTE) or len(frame) == 1:
             return -1, None
 
-        if self.config.dlevel == 'RAW':
-            self.logger.debug('[ HDLC RESPONSE ]: 7e ' + ' '.join(format(x, '02x') for x in packet) + ' 7e')
-        
-        if fcs != self.HDLC_FCS_GOOD:
+        packet = self.unescape(frame[:-1])
+
+        if self.logRaw:
+            self.logger.debug('[ HDLC RESPONSE ]: 7e ' + packet.hex(' ') + ' 7e')
+
+        if self.fcs16buf(packet) != self.HDLC_FCS_GOOD:
             return -1, None
-        else:
-            packet = packet[:-2]  # remove FCS16 from end
-            packet = pack("%dB" % len(packet), *packet)
 
-        return 0, packet
+        # remove FCS16 from end
+        return 0, packet[:-2]
 
-    def encode_byte(self, byte, packet=[]):
-        """ HDLC encode and append a single byte to the given packet. """
-        if (byte == self.HDLC_ESCAPE) or (byte == self.HDLC_FLAG):
-            packet.append(self.HDLC_ESCAPE)
-            packet.append(byte ^ 0x20)
-        else:
-            packet.append(byte)
-        return packet
+    def escape(self, data):
+        """ HDLC escape flag and escape bytes of the given buffer. """
+        return data.replace(b'\x7d', b'\x7d\x5d').replace(b'\x7e', b'\x7d\x5e')
 
-    def encode(self, payload=""):
+    def encode(self, payload=b""):
         """ Return the HDLC encoding of the given packet. """
-        fcs = self.HDLC_FCS_INIT
-        packet = []
-        packet.append(self.HDLC_FLAG)
-        for byte in payload:
-            fcs = self.fcs16(byte, fcs)
-            packet = self.encode_byte(byte, packet)
-
-        fcs ^= 0xffff
-        byte = fcs & 0xFF
-        packet = self.encode_byte(byte, packet)
-        byte = fcs >> 8
-        packet = self.encode_byte(byte, packet)
-        packet.append(self.HDLC_FLAG)
-        packet = pack("%dB" % len(packet), *packet)
-
-        if self.config.dlevel == 'RAW':
-            self.logger.debug("[ HDLC  REQUEST ]: " + ' '.join(format(x, '02x') for x in packet))
+        fcs = self.fcs16buf(payload) ^ 0xffff
+        packet = self.HDLC_FLAG_BYTE + self.escape(bytes(payload) + pack("<H", fcs)) + self.HDLC_FLAG_BYTE
+
+        if self.logRaw:
+            self.logger.debug("[ HDLC  REQUEST ]: " + packet.hex(' '))
         return packet
 
     def sendHdlcPacket(self, data):
@@ -421,24 +555,25 @@ class SpinelProtocolInterface:
     def __init__(self, serial, config, logger):
         self.logger = logger
         self.config = config
+        self.logPacket = config.dlevel in ('RAW', 'PACKET')
 
         self.spinelVersion = ""
         self.hdlc = HdlcLiteProtocolInterface(serial, config, logger)
 
     def encode_i(self, data):
-        result = bytes()
+        result = bytearray()
         while data:
             value = data & 0x7F
             data >>= 7
             if data:
                 value |= 0x80
-            result = result + pack("<B", value)
-        return result
+            result.append(value)
+        return bytes(result)
 
     def encode_packet(self,
                       command_id,
                       payload=bytes()):
-        header = pack(">B", self.HEADER_DEFAULT)
+        header = bytes([self.HEADER_DEFAULT])
         cmd = self.encode_i(command_id)
         pkt = header + cmd + payload
         return pkt
@@ -448,16 +583,16 @@ class SpinelProtocolInterface:
 
         pkt = self.encode_packet(command_id, payload)
 
-        if self.config.dlevel == 'RAW' or self.config.dlevel == 'PACKET':
-            self.logger.debug("[ SPINEL   REQUEST ]: " + ' '.join(format(x, '02x') for x in pkt))
+        if self.logPacket:
+            self.logger.debug("[ SPINEL   REQUEST ]: " + pkt.hex(' '))
 
         status, response = self.hdlc.sendHdlcPacket(pkt)
 
         if status:
-            raise Exception("sendHdlcPacket status error: %d" % status)
+            raise Exception(f"sendHdlcPacket status error: {status}")
 
-        if self.config.dlevel == 'RAW' or self.config.dlevel == 'PACKET':
-            self.logger.debug("[ SPINEL  RESPONSE ]: " + ' '.join(format(x, '02x') for x in response))
+        if self.logPacket:
+            self.logger.debug("[ SPINEL  RESPONSE ]: " + response.hex(' '))
 
         return response
 
@@ -472,24 +607,24 @@ class SpinelProtocolInterface:
             return resp[3:]
 
     def eleLaunchBtl(self):
-        header = pack(">B", self.HEADER_ASYNC)
+        header = bytes([self.HEADER_ASYNC])
         cmd = self.encode_i(self.CMD_MFG_LAUNCH_BOOTLOADER)
         pkt = header + cmd
 
-        if self.config.dlevel == 'RAW' or self.config.dlevel == 'PACKET':
-            self.logger.debug("[ SPINEL   REQUEST ]: " + ' '.join(format(x, '02x') for x in pkt))
+        if self.logPacket:
+            self.logger.debug("[ SPINEL   REQUEST ]: " + pkt.hex(' '))
 
         self.hdlc.sendHdlcPacket(pkt)
 
     def initSpinelProtocol(self):
         self.spinelVersion = ""
 
-        header = pack(">B", self.HEADER_ASYNC)
+        header = bytes([self.HEADER_ASYNC])
         cmd = self.encode_i(self.CMD_RESET)
         pkt = header + cmd
 
-        if self.config.dlevel == 'RAW' or self.config.dlevel == 'PACKET':
-            self.logger.debug("[ SPINEL   REQUEST ]: " + ' '.join(format(x, '02x') for x in pkt))
+        if self.logPacket:
+            self.logger.debug("[ SPINEL   REQUEST ]: " + pkt.hex(' '))
 
         status, response = self.hdlc.sendHdlcPacket(pkt)
 
@@ -501,8 +636,8 @@ class SpinelProtocolInterface:
             return -1
 
 
-        if self.config.dlevel == 'RAW' or self.config.dlevel == 'PACKET':
-            self.logger.debug("[ SPINEL  RESPONSE ]: " + ' '.join(format(x, '02x') for x in response))
+        if self.logPacket:
+            self.logger.debug("[ SPINEL  RESPONSE ]: " + response.hex(' '))
 
         # request version of the SPINEL protocol
         counter = 0
@@ -516,46 +651,51 @@ class SpinelProtocolInterface:
                 else:
                     continue
             self.spinelVersion = "%d.%d"% (response[3],response[4])
-            self.logger.debug("SPINEL v%s detected" % (self.spinelVersion))
+            self.logger.debug("SPINEL v%s detected", self.spinelVersion)
             break
 
         return 0
 
 
 class ElelabsUtilities:
-    def __init__(self, config, logger):
+    def __init__(self, config, logger, parallel=False):
         self.logger = logger
         self.config = config
+        # Set when other threads drive other ports of this process at the same time
+        self.parallel = parallel
+        self.knownEzspVersion = None
 
     def probe(self):
-        serialInterface = SerialInterface(self.config.port, self.config.baudrate)
+        serialInterface = SerialInterface(self.config.port, self.config.baudrate, self.parallel)
         serialInterface.open()
 
-        ezsp = EzspProtocolInterface(serialInterface.serial, self.config, self.logger)
+        ezsp = EzspProtocolInterface(serialInterface.serial, self.config, self.logger, self.knownEzspVersion)
         ezsp_status = ezsp.initEzspProtocol()
         if ezsp_status == 0:
+            self.knownEzspVersion = ezsp.ezspVersion
             status, value_length, value_array = ezsp.getValue(ezsp.EZSP_VALUE_VERSION_INFO, "EZSP_VALUE_VERSION_INFO")
             if (status == 0):
-                firmware_version = str(value_array[2]) + '.' + str(value_array[3]) + '.' + str(value_array[4]) + '-' + str(value_array[0])
+                firmware_version = f'{value_array[2]}.{value_array[3]}.{value_array[4]}-{value_array[0]}'
             else:
-                self.logger.info('EZSP status returned %d' % status)
+                self.logger.info('EZSP status returned %d', status)
 
             token_data_length, token_data = ezsp.getMfgToken(ezsp.EZSP_MFG_STRING, "EZSP_MFG_STRING")
             if token_data.decode("ascii", "ignore") == "Elelabs":
                 token_data_length, token_data = ezsp.getMfgToken(ezsp.EZSP_MFG_BOARD_NAME, "EZSP_MFG_BOARD_NAME")
-                adapter_name = token_data.decode("ascii", "ignore")
+                adapter_name = sys.intern(token_data.decode("ascii", "ignore"))
 
                 self.logger.info("Elelabs Zigbee adapter detected:")
-                self.logger.info("Adapter: %s" % adapter_name)
+                self.logger.info("Adapter: %s", adapter_name)
             else:
                 adapter_name = None
                 self.logger.info("Generic Zigbee EZSP adapter detected:")
 
-            self.logger.info("Firmware: %s" % firmware_version)
-            self.logger.info("EZSP v%d" % ezsp.ezspVersion)
+            self.logger.info("Firmware: %s", firmware_version)
+            self.logger.info("EZSP v%d", ezsp.ezspVersion)
 
+            ezsp.ash.flushAck()
             serialInterface.close()
-            return AdapterModeProbeStatus.ZIGBEE, adapter_name
+            return AdapterModeProbeStatus.ZIGBEE, ADAPTER_ALIASES.get(adapter_name, adapter_name)
         else:
             spinel = SpinelProtocolInterface(serialInterface.serial, self.config, self.logger)
             spinel_status = spinel.initSpinelProtocol()
@@ -567,24 +707,24 @@ class ElelabsUtilities:
                 vendor_name = property_data.decode("ascii", "ignore").rstrip('\x00')
                 if vendor_name == "Elelabs":
                     property_data = spinel.propValueGet(spinel.PROP_MFG_BOARD_NAME)
-                    adapter_name = property_data.decode("ascii", "ignore").rstrip('\x00')
+                    adapter_name = sys.intern(property_data.decode("ascii", "ignore").rstrip('\x00'))
                     
                     self.logger.info("Elelabs Thread adapter detected:")
-                    self.logger.info("Adapter: %s"%adapter_name)
+                    self.logger.info("Adapter: %s", adapter_name)
                 else:
                     adapter_name = None
                     self.logger.info("Generic Thread adapter detected:")
 
-                self.logger.info("Firmware: %s"%firmware_version)
-                self.logger.info("SPINEL v%s" % spinel.spinelVersion)
+                self.logger.info("Firmware: %s", firmware_version)
+                self.logger.info("SPINEL v%s", spinel.spinelVersion)
 
                 serialInterface.close()
-                return AdapterModeProbeStatus.THREAD, adapter_name
+                return AdapterModeProbeStatus.THREAD, ADAPTER_ALIASES.get(adapter_name, adapter_name)
             else:
                 if self.config.baudrate != 115200:
                     serialInterface.close()
                     time.sleep(1)
-                    serialInterface = SerialInterface(self.config.port, 115200)
+                    serialInterface = SerialInterface(self.config.port, 115200, self.parallel)
                     serialInterface.open()
 
                 # check if allready in bootloader mode
@@ -607,14 +747,15 @@ class ElelabsUtilities:
         adapter_status, adapter_name = self.probe()
         if adapter_status == AdapterModeProbeStatus.ZIGBEE or adapter_status == AdapterModeProbeStatus.THREAD:
             if mode == 'btl':
-                serialInterface = SerialInterface(self.config.port, self.config.baudrate)
+                serialInterface = SerialInterface(self.config.port, self.config.baudrate, self.parallel)
                 serialInterface.open()
 
                 self.logger.info("Launch in bootloader mode")
                 if adapter_status == AdapterModeProbeStatus.ZIGBEE:
-                    ezsp = EzspProtocolInterface(serialInterface.serial, self.config, self.logger)
+                    ezsp = EzspProtocolInterface(serialInterface.serial, self.config, self.logger, self.knownEzspVersion)
                     ezsp_status = ezsp.initEzspProtocol()
                     status = ezsp.launchStandaloneBootloader(ezsp.STANDALONE_BOOTLOADER_NORMAL_MODE, "STANDALONE_BOOTLOADER_NORMAL_MODE")
+                    ezsp.ash.flushAck()
                     if status:
                         serialInterface.close()
                         self.logger.critical("Error launching the adapter in bootloader mode")
@@ -649,7 +790,7 @@ class ElelabsUtilities:
                 self.logger.info("Allready in bootloader mode. No need to restart")
                 return 0
             else:
-                serialInterface = SerialInterface(self.config.port, 115200)
+                serialInterface = SerialInterface(self.config.port, 115200, self.parallel)
                 serialInterface.open()
 
                 self.logger.info("Launch in normal application mode")
@@ -674,23 +815,40 @@ class ElelabsUtilities:
             return read_data
 
         def putc(data, timeout=1):
+            # XMODEM hands over a whole block per call and waits for its ACK,
+            # so the write needs no extra pacing
             self.currentPacket += 1
-            if (self.currentPacket % 20) == 0:
-                print('.', end = '')
-            if (self.currentPacket % 100) == 0:
-                print('')
+            if self.parallel:
+                # Dots from several uploads would interleave, log through the port's logger instead
+                if (self.currentPacket % 100) == 0:
+                    self.logger.info(f'Sent {self.currentPacket} blocks')
+            else:
+                if (self.currentPacket % 20) == 0:
+                    print('.', end = '')
+                if (self.currentPacket % 100) == 0:
+                    print('')
             self.serialInterface.serial.write(data)
-            time.sleep(0.001)
 
         if not (".gbl" in filename) and not (".ebl" in filename):
             self.logger.critical('Aborted! Gecko bootloader accepts .gbl or .ebl images only.')
             return
 
+        # Check before the adapter is switched into bootloader mode
+        if not os.path.isfile(filename):
+            self.logger.critical(f'Aborted! Firmware image {filename} not found.')
+            return
+        try:
+            image = load_firmware(filename)
+        except (OSError, ValueError) as e:
+            # mmap refuses empty files with ValueError
+            self.logger.critical(f'Aborted! Cannot read firmware image {filename}: {e}')
+            return
+
         if self.restart("btl"):
             self.logger.critical("EZSP adapter not in the bootloader mode. Can't perform update procedure")
             return
 
-        self.serialInterface = SerialInterface(self.config.port, 115200)
+        self.serialInterface = SerialInterface(self.config.port, 115200, self.parallel)
         self.serialInterface.open()
         # Enter '1' to initialize X-MODEM mode
         self.serialInterface.serial.write(b'\x0A')
@@ -702,24 +860,30 @@ class ElelabsUtilities:
         self.logger.info('Successfully restarted into X-MODEM mode! Starting upload of the new firmware... DO NOT INTERRUPT(!)')
 
         self.currentPacket = 0
-        # Wait for char 'C'
+        # Wait for char 'C', reading whatever arrived in short polls
         success = False
-        start_time = time.time()
-        while time.time()-start_time < 10:
-            if self.serialInterface.serial.read() == b'C':
-                success = True
-                if time.time()-start_time > 5:
-                    break
+        port_timeout = self.serialInterface.serial.timeout
+        self.serialInterface.serial.timeout = 0.1
+        try:
+            start_time = time.time()
+            while time.time()-start_time < 10:
+                if b'C' in self.serialInterface.serial.read(64):
+                    success = True
+                    if time.time()-start_time > 5:
+                        break
+        finally:
+            self.serialInterface.serial.timeout = port_timeout
         if not success:
             self.logger.info('Failed to restart into bootloader mode. Please see users guide.')
             return
         
         # Start XMODEM transaction
-        modem = XMODEM(getc, putc)
-        stream = open(filename,'rb')
-        sentcheck = modem.send(stream)
+        modem = FastXMODEM(getc, putc)
+        with FirmwareReader(image) as stream:
+            sentcheck = modem.send(stream)
 
-        print('')
+        if not self.parallel:
+            print('')
         if sentcheck:
             self.logger.info('Firmware upload complete')
         else:
@@ -737,75 +901,73 @@ class ElelabsUtilities:
 
     def ele_update(self, new_version):
         adapter_status, adapter_name = self.probe()
-        if adapter_status == AdapterModeProbeStatus.ZIGBEE or adapter_status == AdapterModeProbeStatus.THREAD:
-            if adapter_name == None:
-                self.logger.critical("No Elelabs product detected.\r\nUse 'flash' utility for generic EZSP products.\r\nContact info@elelabs.com if you see this message for original Elelabs product")
-                return
-
-            if adapter_name == "ELR023" or adapter_name == "ELU013":
-                if new_version == 'thread':
-                    self.flash("data/EFR32MG13/ELE_MG13_ot_rcp_123_220206.gbl")
-                elif new_version == 'zigbee':
-                    self.flash("data/EFR32MG13/ELE_MG13_zb_ncp_115200_610_211112.gbl")
-                else:
-                    self.logger.critical("Unknown protocol version " + new_version)
-            elif adapter_name == "ELR022" or adapter_name == "ELU012":
-                self.logger.critical("TODO!. Contact Elelabs at info@elelabs.com")
-            elif adapter_name == "EZBPIS" or adapter_name == "EZBUSBA":
-                self.logger.critical("TODO!. Contact Elelabs at info@elelabs.com")
-            elif adapter_name == "ELU0143":
-                if new_version == 'thread':
-                    self.flash("data/EFR32MG21/ELU0143_MG21_ot_rcp_123_220131.gbl")
-                elif new_version == 'zigbee':
-                    self.flash("data/EFR32MG21/ELU0143_MG21_zb_ncp_6103_220131.gbl")
-                else:
-                    self.logger.critical("Unknown protocol version " + new_version)
-            elif adapter_name == "ELU0141" or adapter_name == "ELU0142":
-                if new_version == 'thread':
-                    self.flash("data/EFR32MG21/ELU0141_MG21_ot_rcp_123_211204.gbl")
-                elif new_version == 'zigbee':
-                    self.flash("data/EFR32MG21/ELU0141_MG21_zb_ncp_6103_211204.gbl")
-                else:
-                    self.logger.critical("Unknown protocol version " + new_version)
-            else:
-                self.logger.critical("Unknown Elelabs product %s detected.\r\nContact info@elelabs.com if you see this message for original Elelabs product" % adapter_name)
-        elif adapter_status == AdapterModeProbeStatus.BOOTLOADER:
-            self.logger.critical("The product not in the normal EZSP mode.\r\n'restart' into normal mode or use 'flash' utility instead")
-        else:
-            self.logger.critical("No upgradable device found")
-
-
-
+        if adapter_status in PROBE_STATUS_ERRORS:
+            self.logger.critical(PROBE_STATUS_ERRORS[adapter_status])
+            return
 
-args = parser.parse_args()
+        if adapter_name == None:
+            self.logger.critical("No Elelabs product detected.\r\nUse 'flash' utility for generic EZSP products.\r\nContact info@elelabs.com if you see this message for original Elelabs product")
+            return
 
-main_app_loger = logging.getLogger("Elelabs_EzspFwUtility")
-if args.dlevel == 'INFO':
-    main_app_loger.setLevel(logging.INFO)
-else:
-    main_app_loger.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(asctime)s %(name)s:   %(message)s", datefmt="%Y/%m/%d %H:%M:%S")
-streamHandler = logging.StreamHandler()
-streamHandler.setFormatter(formatter)
-main_app_loger.addHandler(streamHandler)
+        firmware = FW_TABLE.get((adapter_name, new_version))
+        if firmware is not None:
+            self.flash(firmware)
+        elif adapter_name in FW_PRODUCTS:
+            self.logger.critical(f"Unknown protocol version {new_version}")
+        elif adapter_name in FW_UNSUPPORTED:
+            self.logger.critical("TODO!. Contact Elelabs at info@elelabs.com")
+        else:
+            self.logger.critical(f"Unknown Elelabs product {adapter_name} detected.\r\nContact info@elelabs.com if you see this message for original Elelabs product")
 
-elelabs = ElelabsUtilities(args, main_app_loger)
 
-if args.which == 'restart':
-    elelabs.restart(args.mode)
 
-if args.which == 'probe':
-    elelabs.probe()
 
-if args.which == 'ele_update':
-    elelabs.ele_update(args.version)
+def ele_update_all(args, logger):
+    """ Run ele_update on every USB serial port at once, one worker thread per port. """
+    # Only USB adapters report a vid, leaving built-in UARTs and modems alone
+    ports = [port.device for port in serial.tools.list_ports.comports() if port.vid is not None]
+    if not ports:
+        logger.critical("No USB serial ports found")
+        return
 
-if args.which == 'flash':
-    elelabs.flash(args.file)
+    def update(port):
+        config = argparse.Namespace(**vars(args))
+        config.port = port
+        try:
+            ElelabsUtilities(config, logger.getChild(port), parallel=True).ele_update(args.version)
+        except Exception as e:
+            logger.critical(f"{port}: {e}")
 
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(ports)) as executor:
+        list(executor.map(update, ports))
 
+def main():
+    args = parser.parse_args()
+    if not getattr(args, 'which', None):
+        parser.print_help()
+        sys.exit(0)
 
+    main_app_loger = logging.getLogger("Elelabs_EzspFwUtility")
+    main_app_loger.setLevel(LOG_LEVELS.get(args.dlevel, logging.DEBUG))
+    # No-op when a handler is already configured, so repeated runs don't duplicate output
+    logging.basicConfig(format="%(asctime)s %(name)s:   %(message)s", datefmt="%Y/%m/%d %H:%M:%S")
 
+    try:
+        if args.which == 'ele_update' and args.all:
+            ele_update_all(args, main_app_loger)
+            return
 
+        elelabs = ElelabsUtilities(args, main_app_loger)
 
+        commands = {
+            'restart': lambda: elelabs.restart(args.mode),
+            'probe': elelabs.probe,
+            'ele_update': lambda: elelabs.ele_update(args.version),
+            'flash': lambda: elelabs.flash(args.file),
+        }
+        commands[args.which]()
+    finally:
+        close_firmware()
 
+if __name__ == "__main__":
+    main()